@@ -2,7 +2,7 @@
 This file contains Numba-accelerated functions used in the main detections.
 """
 import numpy as np
-from numba import jit
+from numba import jit, prange
 
 __all__ = []
 
@@ -80,3 +80,87 @@ def _detrend(x, y):
     slope = _slope_lstsq(x, y)
     intercept = y.mean() - x.mean() * slope
     return y - (x * slope + intercept)
+
+
+@jit(['float64[:](float64[:, :], int64)', 'float64[:](float32[:, :], int64)'],
+     nopython=True, parallel=True, cache=True)
+def _higuchi_fd(x, kmax):
+    """Fast Higuchi fractal dimension on the last axis of a 2D array.
+    """
+    n_epochs, n_times = x.shape
+    fd = np.empty(n_epochs)
+    x_reg = np.empty(kmax)
+    for k in range(1, kmax + 1):
+        x_reg[k - 1] = np.log(1. / k)
+    for i in prange(n_epochs):
+        y_reg = np.empty(kmax)
+        for k in range(1, kmax + 1):
+            m_lm = 0
+            for m in range(k):
+                ll = 0
+                n_max = (n_times - m - 1) // k
+                for j in range(1, n_max):
+                    ll += abs(x[i, m + j * k] - x[i, m + (j - 1) * k])
+                ll /= k
+                ll *= (n_times - 1) / (k * n_max)
+                m_lm += ll
+            m_lm /= k
+            y_reg[k - 1] = np.log(m_lm)
+        fd[i] = _slope_lstsq(x_reg, y_reg)
+    return fd
+
+
+@jit(['float64[:, :](float64[:, :])', 'float64[:, :](float32[:, :])'],
+     nopython=True, parallel=True, cache=True)
+def _stats_epochs(x):
+    """Fast descriptive statistics on the last axis of a 2D array.
+
+    Returns a (n_epochs, 7) array with the standard deviation (ddof=1),
+    skewness, kurtosis (Fisher), number of zero-crossings, Hjorth mobility,
+    Hjorth complexity and Petrosian fractal dimension of each epoch.
+    """
+    n_epochs, n_times = x.shape
+    out = np.empty((n_epochs, 7))
+    ln10 = np.log10(n_times)
+    for i in prange(n_epochs):
+        mx = 0
+        for t in range(n_times):
+            mx += x[i, t]
+        mx /= n_times
+        # Mean of the first and second derivatives
+        md = (x[i, n_times - 1] - x[i, 0]) / (n_times - 1)
+        mdd = (x[i, n_times - 1] - x[i, n_times - 2] - x[i, 1] + x[i, 0]
+               ) / (n_times - 2)
+        m2, m3, m4, vd, vdd, nzc, nzc_d, d_prev = 0, 0, 0, 0, 0, 0, 0, 0
+        for t in range(n_times):
+            xm = x[i, t] - mx
+            xm2 = xm * xm
+            m2 += xm2
+            m3 += xm2 * xm
+            m4 += xm2 * xm2
+            if t > 0:
+                if x[i, t - 1] * x[i, t] < 0:
+                    nzc += 1
+                # First derivative, kept for the next sample
+                d = x[i, t] - x[i, t - 1]
+                dm = d - md
+                vd += dm * dm
+                if t > 1:
+                    if d_prev * d < 0:
+                        nzc_d += 1
+                    ddm = d - d_prev - mdd
+                    vdd += ddm * ddm
+                d_prev = d
+        m2 /= n_times
+        m3 /= n_times
+        m4 /= n_times
+        vd /= n_times - 1
+        vdd /= n_times - 2
+        out[i, 0] = np.sqrt(m2 * n_times / (n_times - 1))
+        out[i, 1] = m3 / m2**1.5
+        out[i, 2] = m4 / m2**2 - 3
+        out[i, 3] = nzc
+        out[i, 4] = np.sqrt(vd / m2)
+        out[i, 5] = np.sqrt(vdd / vd) / out[i, 4]
+        out[i, 6] = ln10 / (ln10 + np.log10(n_times / (n_times + 0.4 * nzc_d)))
+    return out
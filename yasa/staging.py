@@ -5,26 +5,120 @@ import joblib
 import logging
 import numpy as np
 import pandas as pd
-import entropy as ent
+import scipy.fft as sp_fft
 import scipy.signal as sp_sig
 import scipy.stats as sp_stats
 import matplotlib.pyplot as plt
+from math import factorial
+from functools import lru_cache
 from mne.filter import filter_data
-from sklearn.preprocessing import robust_scale
+from numpy.lib.stride_tricks import as_strided
 
+from .numba import _higuchi_fd, _stats_epochs
 from .others import sliding_window
 from .spectral import bandpower_from_psd_ndarray
 
 logger = logging.getLogger('yasa')
 
+# Extensions of the Treelite-compiled classifiers, in order of precedence
+_LIB_EXTENSIONS = ('.so', '.dylib', '.dll')
+
+
+def _sliding_windows(x, window, step=1):
+    """Read-only view of the sliding windows on the last axis of x.
+
+    Returns an array of shape (..., n_windows, window). Unlike
+    :py:func:`yasa.sliding_window`, the window and step are in samples and
+    the leading axes are kept in place.
+    """
+    n_windows = (x.shape[-1] - window) // step + 1
+    shape = x.shape[:-1] + (n_windows, window)
+    strides = x.strides[:-1] + (x.strides[-1] * step, x.strides[-1])
+    return as_strided(x, shape=shape, strides=strides, writeable=False)
+
+
+def _perm_entropy(x, order=3):
+    """Normalized permutation entropy of each row of a 2D array.
+
+    Same as ``entropy.perm_entropy(row, order=order, normalize=True)`` for
+    each row, but with the permutations of all the rows counted at once.
+    """
+    n_epochs, n_hash = x.shape[0], order ** order
+    # Sort the order of permutations in each sliding window
+    sorted_idx = _sliding_windows(x, order).argsort(axis=-1, kind='quicksort')
+    # Associate unique integer to each permutations
+    hashval = (sorted_idx * order ** np.arange(order)).sum(axis=-1)
+    # Count the permutations of all epochs at once
+    hashval += n_hash * np.arange(n_epochs)[:, np.newaxis]
+    counts = np.bincount(hashval.ravel(), minlength=n_epochs * n_hash)
+    p = counts.reshape(n_epochs, n_hash) / hashval.shape[1]
+    plogp = p * np.log2(p, out=np.zeros_like(p), where=p > 0)
+    return -plogp.sum(axis=1) / np.log2(factorial(order))
+
+
+def _welch(x, sf, window):
+    """Welch's power spectral density on the last axis of x.
+
+    Same as ``scipy.signal.welch(x, sf, window=window, average='median')``,
+    where window is an array (e.g. the output of
+    :py:func:`scipy.signal.get_window`), but with all the segments of all
+    the leading axes transformed in a single batched FFT.
+    """
+    win = len(window)
+    # 50% overlapping segments (noverlap = win // 2), shape
+    # (..., n_segments, win)
+    segs = _sliding_windows(x, win, step=win - win // 2)
+    segs = (segs - segs.mean(axis=-1, keepdims=True)) * window
+    psd = np.abs(sp_fft.rfft(segs, axis=-1))**2
+    psd /= sf * (window**2).sum()
+    # One-sided spectrum: double all but the DC and Nyquist bins
+    psd[..., 1:(win + 1) // 2] *= 2
+    # Median average, corrected for its bias w.r.t. the mean
+    n_seg = segs.shape[-2]
+    ii = np.arange(1, (n_seg - 1) // 2 + 1)
+    bias = 1 + np.sum(1 / (2 * ii + 1) - 1 / (2 * ii))
+    return np.median(psd, axis=-2) / bias
+
+
+def _rolling_mean(x, weights, center):
+    """Weighted rolling average on the first axis of x.
+
+    Same as ``pd.DataFrame(x).rolling(window=len(weights), center=center,
+    min_periods=1, win_type=...).mean()``, i.e. missing values and samples
+    outside the edges are ignored, but with all the columns convolved at
+    once.
+    """
+    valid = ~np.isnan(x)
+    w = weights[:, np.newaxis].astype(x.dtype)
+    num = sp_sig.convolve(np.where(valid, x, 0), w, method='direct')
+    den = sp_sig.convolve(valid.astype(x.dtype), w, method='direct')
+    start = (len(weights) - 1) // 2 if center else 0
+    idx = slice(start, start + x.shape[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return num[idx] / den[idx]
+
+
+def _robust_scale_inplace(x):
+    """Center and scale each column of x, in place, using its median and
+    5-95 percentile range. Missing values are ignored.
+
+    Same as ``sklearn.preprocessing.robust_scale(x, quantile_range=(5, 95))``,
+    without the intermediate copies.
+    """
+    q5, median, q95 = np.nanpercentile(x, [5, 50, 95], axis=0)
+    scale = q95 - q5
+    scale[scale == 0] = 1
+    x -= median
+    x /= scale
+    return x
+
 
 class SleepStaging:
     """
     Automatic sleep staging of polysomnography data.
 
     To run the automatic sleep staging, you must install the
-    `LightGBM <https://lightgbm.readthedocs.io/>`_ and
-    `entropy <https://github.com/raphaelvallat/entropy>`_ packages.
+    `LightGBM <https://lightgbm.readthedocs.io/>`_ package.
 
     .. versionadded:: 0.4.0
 
@@ -191,6 +285,12 @@ class SleepStaging:
     >>> sls.plot_predict_proba()
     """
 
+    # LightGBM parameters of the prediction early stopping. The margin is
+    # in raw score units: the default classifiers rarely exceed a final
+    # margin of 5 between the two most likely stages.
+    _EARLY_STOP_DEFAULTS = dict(pred_early_stop=True, pred_early_stop_freq=10,
+                                pred_early_stop_margin=4.0)
+
     def __init__(self, raw, eeg_name, *, eog_name=None, emg_name=None,
                  metadata=None):
         # Type check
@@ -211,18 +311,12 @@ class SleepStaging:
         # Validate Raw instance and load data
         assert isinstance(raw, mne.io.BaseRaw), 'raw must be a MNE Raw object.'
         sf = raw.info['sfreq']
-        ch_names = np.array([eeg_name, eog_name, emg_name])
-        ch_types = np.array(['eeg', 'eog', 'emg'])
-        keep_chan = []
+        # Keep only the channels that are not None
+        ch_names, ch_types = map(list, zip(*[
+            (c, t) for c, t in zip([eeg_name, eog_name, emg_name],
+                                   ['eeg', 'eog', 'emg']) if c is not None]))
         for c in ch_names:
-            if c is not None:
-                assert c in raw.ch_names, '%s does not exist' % c
-                keep_chan.append(True)
-            else:
-                keep_chan.append(False)
-        # Subset
-        ch_names = ch_names[keep_chan].tolist()
-        ch_types = ch_types[keep_chan].tolist()
+            assert c in raw.ch_names, '%s does not exist' % c
         # Keep only selected channels (creating a copy of Raw)
         raw_pick = raw.copy().pick_channels(ch_names, ordered=True)
 
@@ -232,8 +326,8 @@ class SleepStaging:
             raw_pick.resample(100, npad="auto")
             sf = 100
 
-        # Get data and convert to microVolts
-        data = raw_pick.get_data() * 1e6
+        # Get data and convert to microVolts (single precision is enough)
+        data = (raw_pick.get_data() * 1e6).astype(np.float32)
 
         # Extract duration of recording in minutes
         duration_minutes = data.shape[1] / sf / 60
@@ -263,65 +357,65 @@ class SleepStaging:
         win_sec = 5  # = 2 / freq_broad[0]
         sf = self.sf
         win = int(win_sec * sf)
-        kwargs_welch = dict(window='hamming', nperseg=win, average='median')
+        window = sp_sig.get_window('hamming', win).astype(np.float32)
+        freqs = sp_fft.rfftfreq(win, 1 / sf)
+        # Frequency resolution and broadband slice (for the total power)
+        dx = freqs[1] - freqs[0]
+        idx_broad = slice(np.searchsorted(freqs, freq_broad[0], side='left'),
+                          np.searchsorted(freqs, freq_broad[1], side='right'))
         bands = [
             (0.4, 1, 'sdelta'), (1, 4, 'fdelta'), (4, 8, 'theta'),
             (8, 12, 'alpha'), (12, 16, 'sigma'), (16, 30, 'beta')
         ]
 
-        #######################################################################
-        # HELPER FUNCTIONS
-        #######################################################################
-
-        def nzc(x):
-            """Calculate the number of zero-crossings along the last axis."""
-            return ((x[..., :-1] * x[..., 1:]) < 0).sum(axis=1)
-
-        def mobility(x):
-            """Calculate Hjorth mobility on the last axis."""
-            return np.sqrt(np.diff(x, axis=1).var(axis=1) / x.var(axis=1))
-
-        def petrosian(x):
-            """Calculate the Petrosian fractal dimension on the last axis."""
-            n = x.shape[1]
-            ln10 = np.log10(n)
-            diff = np.diff(x, axis=1)
-            return ln10 / (ln10 + np.log10(n / (n + 0.4 * nzc(diff))))
-
         #######################################################################
         # CALCULATE FEATURES
         #######################################################################
 
-        features = []
-
-        for i, c in enumerate(self.ch_types):
-            # Preprocessing
-            # - Filter the data
-            dt_filt = filter_data(
-                self.data[i, :],
-                sf, l_freq=freq_broad[0], h_freq=freq_broad[1], verbose=False)
-            # - Extract epochs. Data is now of shape (n_epochs, n_samples).
-            times, epochs = sliding_window(dt_filt, sf=sf, window=30)
+        # Preprocessing
+        # - Filter the data of all channels at once (MNE requires float64).
+        # MNE filters the channels one after the other, single-threaded.
+        dt_filt = filter_data(
+            self.data.astype(np.float64), sf, l_freq=freq_broad[0],
+            h_freq=freq_broad[1], verbose=False).astype(np.float32)
+        # - Extract epochs. Data is now (n_chan, n_epochs, n_samples).
+        times, epochs_all = sliding_window(dt_filt, sf=sf, window=30)
+        epochs_all = np.swapaxes(epochs_all, 0, 1)
+        # - Calculate the power spectrum of all channels at once. The batched
+        # FFT is split across all the available CPUs (scipy.fft workers).
+        with sp_fft.set_workers(-1):
+            psd_all = _welch(epochs_all, sf, window)
+        # - Calculate the relative bandpowers of all channels at once,
+        # shape (n_bands, n_chan, n_epochs). Only used for EEG + EOG.
+        bp_all = bandpower_from_psd_ndarray(psd_all, freqs, bands=bands)
+
+        # The Numba kernels are already parallelized across epochs and must
+        # not be launched concurrently, so run them before the channel loop.
+        stats_all = [_stats_epochs(epochs) for epochs in epochs_all]
+        higuchi_all = [_higuchi_fd(epochs, 10) for epochs in epochs_all]
+
+        def channel_features(i, c):
+            """Calculate the features of a single channel."""
+            # Data of the current channel, shape (n_epochs, n_samples)
+            epochs, psd = epochs_all[i], psd_all[i]
 
             # Calculate standard descriptive statistics
-            hmob = mobility(epochs)
+            std, skew, kurt, n_zc, hmob, hcomp, pfd = stats_all[i].T
 
             feat = {
-                'std': np.std(epochs, ddof=1, axis=1),
+                'std': std,
                 'iqr': sp_stats.iqr(epochs, rng=(25, 75), axis=1),
-                'skew': sp_stats.skew(epochs, axis=1),
-                'kurt': sp_stats.kurtosis(epochs, axis=1),
-                'nzc': nzc(epochs),
+                'skew': skew,
+                'kurt': kurt,
+                'nzc': n_zc.astype(int),
                 'hmob': hmob,
-                'hcomp': mobility(np.diff(epochs, axis=1)) / hmob
+                'hcomp': hcomp
             }
 
             # Calculate spectral power features (for EEG + EOG)
-            freqs, psd = sp_sig.welch(epochs, sf, **kwargs_welch)
             if c != 'emg':
-                bp = bandpower_from_psd_ndarray(psd, freqs, bands=bands)
                 for j, (_, _, b) in enumerate(bands):
-                    feat[b] = bp[j]
+                    feat[b] = bp_all[j, i]
 
             # Add power ratios for EEG
             if c == 'eeg':
@@ -331,62 +425,68 @@ class SleepStaging:
                 feat['db'] = delta / feat['beta']
                 feat['at'] = feat['alpha'] / feat['theta']
 
-            # Add total power
-            idx_broad = np.logical_and(
-                freqs >= freq_broad[0], freqs <= freq_broad[1])
-            dx = freqs[1] - freqs[0]
-            feat['abspow'] = np.trapz(psd[:, idx_broad], dx=dx)
+            # Add total power (trapezoidal rule on the broadband slice)
+            psd_broad = psd[:, idx_broad]
+            feat['abspow'] = dx * (psd_broad.sum(axis=1) - (
+                psd_broad[:, 0] + psd_broad[:, -1]) / 2)
 
             # Calculate entropy and fractal dimension features
-            feat['perm'] = np.apply_along_axis(
-                ent.perm_entropy, axis=1, arr=epochs, normalize=True)
-            feat['higuchi'] = np.apply_along_axis(
-                ent.higuchi_fd, axis=1, arr=epochs)
-            feat['petrosian'] = petrosian(epochs)
+            feat['perm'] = _perm_entropy(epochs)
+            feat['higuchi'] = higuchi_all[i]
+            feat['petrosian'] = pfd
 
             # Convert to dataframe
-            feat = pd.DataFrame(feat).add_prefix(c + '_')
-            features.append(feat)
+            return pd.DataFrame(feat).add_prefix(c + '_')
+
+        # The channels are independent and most of the remaining work (sorts,
+        # reductions) releases the GIL, so process them in parallel threads,
+        # which share the epochs instead of copying them to other processes.
+        features = joblib.Parallel(n_jobs=len(self.ch_types),
+                                   prefer='threads')(
+            joblib.delayed(channel_features)(i, c)
+            for i, c in enumerate(self.ch_types))
 
         #######################################################################
         # SMOOTHING & NORMALIZATION
         #######################################################################
 
-        # Save features to dataframe
+        # Save features to dataframe. Downcast float64 to float32 now, which
+        # halves the memory traffic of the smoothing and normalization.
         features = pd.concat(features, axis=1)
         features.index.name = 'epoch'
+        cols_float = features.select_dtypes(np.float64).columns.tolist()
+        features[cols_float] = features[cols_float].astype(np.float32)
+        X = features.to_numpy(dtype=np.float32)
 
         # Apply centered rolling average (11 epochs = 5 min 30)
         # Triang: [1/6, 2/6, 3/6, 4/6, 5/6, 6/6 (X), 5/6, 4/6, 3/6, 2/6, 1/6]
-        rollc = features.rolling(
-            window=11, center=True, min_periods=1, win_type='triang').mean()
-        rollc[rollc.columns] = robust_scale(rollc, quantile_range=(5, 95))
+        rollc = _rolling_mean(X, sp_sig.windows.triang(11), center=True)
+        rollc = pd.DataFrame(_robust_scale_inplace(rollc), index=features.index,
+                             columns=features.columns)
         rollc = rollc.add_suffix('_c5min_norm')
 
         # Now look at the past 5 minutes
-        rollp = features.rolling(window=10, min_periods=1).mean()
-        rollp[rollp.columns] = robust_scale(rollp, quantile_range=(5, 95))
+        rollp = _rolling_mean(X, np.ones(10), center=False)
+        rollp = pd.DataFrame(_robust_scale_inplace(rollp), index=features.index,
+                             columns=features.columns)
         rollp = rollp.add_suffix('_p5min_norm')
 
-        # Add to current set of features
-        features = features.join(rollc).join(rollp)
+        # Add to current set of features (all share the same epoch index)
+        features = pd.concat([features, rollc, rollp], axis=1)
 
         #######################################################################
         # TEMPORAL + METADATA FEATURES AND EXPORT
         #######################################################################
 
         # Add temporal features
-        features['time_hour'] = times / 3600
-        features['time_norm'] = times / times[-1]
+        features['time_hour'] = (times / 3600).astype(np.float32)
+        features['time_norm'] = (times / times[-1]).astype(np.float32)
 
         # Add metadata if present
         if self.metadata is not None:
             for c in self.metadata.keys():
                 features[c] = self.metadata[c]
 
-        # Downcast float64 to float32 (to reduce size of training datasets)
-        cols_float = features.select_dtypes(np.float64).columns.tolist()
-        features[cols_float] = features[cols_float].astype(np.float32)
         # Make sure that age and sex are encoded as int
         if 'age' in features.columns:
             features['age'] = features['age'].astype(int)
@@ -441,13 +541,20 @@ class SleepStaging:
             path_to_model = clf_dir + name + '_lgb_' + yv + '.joblib'
         # Check that file exists
         assert os.path.isfile(path_to_model), "File does not exist."
-        # Load using Joblib
-        clf = joblib.load(path_to_model)
+        # Look for a compiled version of the classifier, e.g. clf.so
+        root = os.path.splitext(path_to_model)[0]
+        path_to_lib = next((root + ext for ext in _LIB_EXTENSIONS
+                            if os.path.isfile(root + ext)), None)
+        mtime_lib = os.path.getmtime(path_to_lib) if path_to_lib else None
+        # Load the classifier, or get it from the cache if the classifier
+        # and its compiled version have not been modified
+        clf = _load_classifier(path_to_model, os.path.getmtime(path_to_model),
+                               path_to_lib, mtime_lib)
         # Validate features
         self._validate_predict(clf)
         return clf
 
-    def predict(self, path_to_model="auto"):
+    def predict(self, path_to_model="auto", pred_early_stop=False):
         """
         Return the predicted sleep stage for each 30-sec epoch of data.
 
@@ -460,6 +567,22 @@ class SleepStaging:
         path_to_model : str or "auto"
             Full path to a trained LGBMClassifier, exported as a
             joblib file. Can be "auto" to use YASA's default classifier.
+            If a `Treelite <https://treelite.readthedocs.io/>`_-compiled
+            shared library of the classifier is located next to the joblib
+            file (``clf.so``, ``clf.dylib`` or ``clf.dll`` for
+            ``clf.joblib``, looked up in this order), it is used instead
+            for faster predictions. It can be generated with:
+
+            >>> import treelite
+            >>> model = treelite.Model.from_lightgbm(clf.booster_)
+            >>> model.export_lib(toolchain='gcc', libpath='clf.so')
+        pred_early_stop : bool
+            If True, use LightGBM's prediction early stopping, i.e. stop
+            evaluating the trees for a given epoch once the margin between
+            the most likely sleep stages is large enough. This is faster and
+            rarely changes the predicted sleep stages, but the predicted
+            probabilities are only approximate. Ignored by compiled
+            classifiers. Default is False.
 
         Returns
         -------
@@ -470,16 +593,25 @@ class SleepStaging:
             self.fit()
         # Load and validate pre-trained classifier
         clf = self._load_model(path_to_model)
-        # Now we make sure that the features are aligned
-        X = self._features.copy()[clf.feature_name_]
-        # Predict the sleep stages and probabilities
-        self._predicted = clf.predict(X)
-        proba = pd.DataFrame(clf.predict_proba(X), columns=clf.classes_)
+        # Now we make sure that the features are aligned. LightGBM predicts
+        # directly from a C-contiguous float32 array, without any conversion.
+        X = np.ascontiguousarray(self._features[clf.feature_name_],
+                                 dtype=np.float32)
+        # Predict the sleep stages and probabilities. With only a few hundred
+        # epochs, LightGBM is faster single-threaded than multi-threaded.
+        kwargs = dict(num_threads=1)
+        if pred_early_stop:
+            kwargs.update(self._EARLY_STOP_DEFAULTS)
+        self._predicted = clf.predict(X, **kwargs)
+        proba = pd.DataFrame(clf.predict_proba(X, **kwargs),
+                             columns=clf.classes_)
         proba.index.name = 'epoch'
         self._proba = proba
+        # Remember whether the probabilities are exact or approximate
+        self._proba_early_stop = pred_early_stop
         return self._predicted.copy()
 
-    def predict_proba(self, path_to_model="auto"):
+    def predict_proba(self, path_to_model="auto", pred_early_stop=False):
         """
         Return the predicted probability for each sleep stage for each 30-sec
         epoch of data.
@@ -493,6 +625,22 @@ class SleepStaging:
         path_to_model : str or "auto"
             Full path to a trained LGBMClassifier, exported as a
             joblib file. Can be "auto" to use YASA's default classifier.
+            If a `Treelite <https://treelite.readthedocs.io/>`_-compiled
+            shared library of the classifier is located next to the joblib
+            file (``clf.so``, ``clf.dylib`` or ``clf.dll`` for
+            ``clf.joblib``, looked up in this order), it is used instead
+            for faster predictions. It can be generated with:
+
+            >>> import treelite
+            >>> model = treelite.Model.from_lightgbm(clf.booster_)
+            >>> model.export_lib(toolchain='gcc', libpath='clf.so')
+        pred_early_stop : bool
+            If True, use LightGBM's prediction early stopping, i.e. stop
+            evaluating the trees for a given epoch once the margin between
+            the most likely sleep stages is large enough. This is faster and
+            rarely changes the predicted sleep stages, but the predicted
+            probabilities are only approximate. Ignored by compiled
+            classifiers. Default is False.
 
         Returns
         -------
@@ -500,8 +648,9 @@ class SleepStaging:
             The predicted probability for each sleep stage for each 30-sec
             epoch of data.
         """
-        if not hasattr(self, '_proba'):
-            self.predict(path_to_model)
+        if (not hasattr(self, '_proba') or
+                self._proba_early_stop != pred_early_stop):
+            self.predict(path_to_model, pred_early_stop=pred_early_stop)
         return self._proba.copy()
 
     def plot_predict_proba(self, proba=None, majority_only=False,
@@ -541,3 +690,53 @@ class SleepStaging:
         ax.set_xlabel("Time (30-sec epoch)")
         plt.legend(frameon=False, bbox_to_anchor=(1, 1))
         return ax
+
+
+@lru_cache(maxsize=4)
+def _load_classifier(path_to_model, mtime, path_to_lib, mtime_lib):
+    """Load a trained classifier, using its Treelite-compiled version if any.
+
+    The loaded classifiers are cached. ``mtime`` and ``mtime_lib`` are the
+    modification times of the joblib file and compiled library (or None)
+    and are only used to invalidate the cache when the files change.
+    """
+    # Load using Joblib
+    clf = joblib.load(path_to_model)
+    # Use the Treelite-compiled classifier if present, e.g. clf.so
+    if path_to_lib is not None:
+        try:
+            clf = _TreeliteClassifier(clf, path_to_lib)
+        except ImportError:
+            logger.warning('treelite_runtime is not installed. Ignoring '
+                           'compiled classifier %s.', path_to_lib)
+    return clf
+
+
+class _TreeliteClassifier:
+    """Treelite-compiled version of a trained LGBMClassifier.
+
+    Exposes the same attributes and prediction methods as the original
+    classifier and can therefore be used as a drop-in replacement.
+    """
+
+    def __init__(self, clf, path_to_lib):
+        import treelite_runtime
+        self.classes_ = clf.classes_
+        self.feature_name_ = clf.feature_name_
+        self._predictor = treelite_runtime.Predictor(path_to_lib, nthread=1)
+
+    def predict_proba(self, X, **kwargs):
+        """Return the predicted probability of each class.
+
+        LightGBM-specific keyword arguments are ignored.
+        """
+        import treelite_runtime
+        dmat = treelite_runtime.DMatrix(np.asarray(X, dtype=np.float32))
+        return self._predictor.predict(dmat)
+
+    def predict(self, X, **kwargs):
+        """Return the predicted class.
+
+        LightGBM-specific keyword arguments are ignored.
+        """
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
@@ -4,7 +4,9 @@ Test the functions in the yasa/numba.py file.
 import unittest
 import numpy as np
 from scipy.signal import detrend
-from yasa.numba import _corr, _covar, _rms, _slope_lstsq, _detrend
+from scipy.stats import skew, kurtosis
+from yasa.numba import (_corr, _covar, _rms, _slope_lstsq, _detrend,
+                        _higuchi_fd, _stats_epochs)
 
 
 class TestNumba(unittest.TestCase):
@@ -29,3 +31,34 @@ class TestNumba(unittest.TestCase):
         X = np.column_stack((np.ones(X.shape[0]), X))
         slope_np = np.linalg.lstsq(X, y, rcond=None)[0][1]
         np.round(slope, 5) == np.round(slope_np, 5)
+
+        # Higuchi fractal dimension: ~1 for a line, ~2 for white noise
+        x = np.vstack((np.arange(3000, dtype=np.float64),
+                       np.random.normal(size=3000)))
+        fd = _higuchi_fd(x, 10)
+        assert fd.shape == (2,)
+        np.testing.assert_allclose(fd, [1, 2], atol=0.05)
+        np.testing.assert_array_equal(_higuchi_fd(x[1:], 10), fd[1:])
+        np.testing.assert_allclose(_higuchi_fd(x.astype(np.float32), 10), fd,
+                                   rtol=1e-4)
+
+        # Descriptive statistics of each epoch
+        x = np.random.normal(loc=2, scale=10, size=(5, 3000))
+        stats = _stats_epochs(x)
+        assert stats.shape == (5, 7)
+        np.testing.assert_allclose(stats[:, 0], x.std(ddof=1, axis=1))
+        np.testing.assert_allclose(stats[:, 1], skew(x, axis=1))
+        np.testing.assert_allclose(stats[:, 2], kurtosis(x, axis=1))
+        np.testing.assert_array_equal(stats[:, 3],
+                                      ((x[:, :-1] * x[:, 1:]) < 0).sum(1))
+        dx = np.diff(x, axis=1)
+        hmob = np.sqrt(dx.var(axis=1) / x.var(axis=1))
+        hcomp = np.sqrt(np.diff(dx, axis=1).var(axis=1) / dx.var(axis=1))
+        np.testing.assert_allclose(stats[:, 4], hmob)
+        np.testing.assert_allclose(stats[:, 5], hcomp / hmob)
+        ln10 = np.log10(3000)
+        nzc_dx = ((dx[:, :-1] * dx[:, 1:]) < 0).sum(1)
+        pfd = ln10 / (ln10 + np.log10(3000 / (3000 + 0.4 * nzc_dx)))
+        np.testing.assert_allclose(stats[:, 6], pfd)
+        np.testing.assert_allclose(_stats_epochs(x.astype(np.float32)), stats,
+                                   rtol=1e-4)
@@ -1,11 +1,24 @@
 """
 Test the functions in yasa/staging.py.
 """
+import os
 import mne
+import shutil
+import tempfile
 import unittest
 import numpy as np
+import pandas as pd
+import scipy.signal as sp_sig
 import matplotlib.pyplot as plt
-from yasa.staging import SleepStaging
+from types import ModuleType
+from unittest.mock import patch
+from sklearn.preprocessing import robust_scale
+from yasa.staging import (SleepStaging, _sliding_windows, _perm_entropy,
+                          _welch, _rolling_mean, _robust_scale_inplace)
+
+# Default EEG-only classifier
+path_clf = os.path.join(os.path.dirname(__file__), '..', 'classifiers',
+                        'clf_eeg_lgb_0.4.0.joblib')
 
 ##############################################################################
 # DATA LOADING
@@ -20,6 +33,67 @@ hypno = np.loadtxt('notebooks/sub-02_hypno_30s.txt', dtype=str)
 class TestStaging(unittest.TestCase):
     """Test SleepStaging."""
 
+    def test_sliding_windows(self):
+        """Test the sliding windows used in the features extraction"""
+        x = np.arange(20).reshape(2, 10)
+        win = _sliding_windows(x, 3)
+        assert win.shape == (2, 8, 3)
+        np.testing.assert_array_equal(win[1, 2], [12, 13, 14])
+        win = _sliding_windows(x, 4, step=2)
+        assert win.shape == (2, 4, 4)
+        np.testing.assert_array_equal(win[0, -1], [6, 7, 8, 9])
+        assert not win.flags.writeable
+
+    def test_perm_entropy(self):
+        """Test the batched permutation entropy"""
+        # A monotonic series only has one permutation
+        np.testing.assert_allclose(_perm_entropy(np.arange(20.)[None]), 0)
+        # Values from entropy.perm_entropy(row, order, normalize=True)
+        x = np.array([[4, 7, 9, 10, 6, 11, 3, 2, 8, 5, 1, 12],
+                      [1, 3, 2, 5, 4, 7, 6, 9, 8, 11, 10, 12]], dtype=float)
+        np.testing.assert_allclose(_perm_entropy(x),
+                                   [0.8690413667681063, 0.38685280723454163])
+        np.testing.assert_allclose(_perm_entropy(x, order=4),
+                                   [0.6913742480868106, 0.21615794233482577])
+
+    def test_welch(self):
+        """Test the batched Welch's PSD against scipy.signal.welch"""
+        rng = np.random.RandomState(42)
+        x = rng.normal(size=(2, 3, 3000))
+        for win in [500, 501]:
+            psd = _welch(x, 100, sp_sig.get_window('hamming', win))
+            _, psd_sp = sp_sig.welch(x, 100, window='hamming', nperseg=win,
+                                     average='median')
+            assert psd.shape == psd_sp.shape
+            np.testing.assert_allclose(psd, psd_sp, rtol=1e-10)
+
+    def test_rolling_mean(self):
+        """Test the weighted rolling average against pandas"""
+        rng = np.random.RandomState(42)
+        x = rng.normal(size=(60, 4))
+        x[[0, 5, 6, 30], 0] = np.nan
+        x[10:25, 1] = np.nan  # Longer than the windows
+        x[-1, 2] = np.nan
+        df = pd.DataFrame(x)
+        rollc = _rolling_mean(x, sp_sig.windows.triang(11), center=True)
+        np.testing.assert_allclose(
+            rollc, df.rolling(11, center=True, min_periods=1,
+                              win_type='triang').mean())
+        rollp = _rolling_mean(x, np.ones(10), center=False)
+        np.testing.assert_allclose(
+            rollp, df.rolling(10, min_periods=1).mean())
+
+    def test_robust_scale_inplace(self):
+        """Test the in-place robust scaling against scikit-learn"""
+        rng = np.random.RandomState(42)
+        x = rng.normal(size=(100, 3))
+        x[[3, 50], 0] = np.nan
+        x[:, 2] = 1  # Zero range
+        expected = robust_scale(x, quantile_range=(5, 95))
+        out = _robust_scale_inplace(x)
+        assert out is x
+        np.testing.assert_allclose(x, expected)
+
     def test_sleep_staging(self):
         """Test sleep staging"""
         sls = SleepStaging(raw, eeg_name="C4", eog_name="EOG1",
@@ -31,6 +105,15 @@ class TestStaging(unittest.TestCase):
         # Check that the accuracy is at least 80%
         accuracy = (hypno == y_pred).sum() / y_pred.size
         assert accuracy > 0.80
+        # Prediction early stopping should give (almost) the same stages
+        y_pred_es = sls.predict(pred_early_stop=True)
+        assert (y_pred_es == y_pred).mean() > 0.95
+        # ... but the exact probabilities are recomputed when requested
+        proba_es = sls.predict_proba(pred_early_stop=True)
+        assert not proba_es.equals(proba)
+        assert sls.predict_proba().equals(proba)
+        # The classifier is only loaded once
+        assert sls._load_model("auto") is sls._load_model("auto")
 
         # Plot
         sls.plot_predict_proba()
@@ -45,3 +128,56 @@ class TestStaging(unittest.TestCase):
         SleepStaging(raw, eeg_name="C4", eog_name="EOG1").fit()
         # .. just the EEG
         SleepStaging(raw, eeg_name="C4").fit()
+
+    def test_compiled_classifier(self):
+        """Test the Treelite-compiled classifier"""
+        sls = SleepStaging(raw, eeg_name="C4")
+        y_lgb = sls.predict(path_clf)
+        proba_lgb = sls.predict_proba()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path_model = os.path.join(tmpdir, 'clf.joblib')
+            shutil.copy(path_clf, path_model)
+            # Empty sibling library + treelite_runtime not installed:
+            # warning and fallback to the LightGBM classifier
+            open(os.path.join(tmpdir, 'clf.so'), 'w').close()
+            with patch.dict('sys.modules', {'treelite_runtime': None}):
+                with self.assertLogs('yasa', level='WARNING') as logs:
+                    clf = sls._load_model(path_model)
+            assert 'treelite_runtime is not installed' in logs.output[0]
+            assert type(clf).__name__ == 'LGBMClassifier'
+            np.testing.assert_array_equal(sls.predict(path_model), y_lgb)
+
+            # Stub treelite_runtime that returns the LightGBM probabilities
+            # of the epochs in reverse order
+            libpaths = []
+
+            class Predictor:
+                def __init__(self, libpath, nthread=None):
+                    libpaths.append(libpath)
+
+                def predict(self, dmat):
+                    assert dmat.dtype == np.float32
+                    return proba_lgb.to_numpy()[::-1]
+
+            stub = ModuleType('treelite_runtime')
+            stub.Predictor, stub.DMatrix = Predictor, np.asarray
+            # Touch the library to invalidate the cached classifier
+            os.utime(os.path.join(tmpdir, 'clf.so'), (0, 0))
+            with patch.dict('sys.modules', {'treelite_runtime': stub}):
+                clf = sls._load_model(path_model)
+                assert type(clf).__name__ == '_TreeliteClassifier'
+                assert clf.feature_name_ == sls.feature_name_
+                y_pred = sls.predict(path_model)
+                proba = sls.predict_proba()
+            np.testing.assert_array_equal(y_pred, y_lgb[::-1])
+            np.testing.assert_array_equal(proba.columns, clf.classes_)
+            np.testing.assert_array_equal(proba, proba_lgb.to_numpy()[::-1])
+            assert libpaths == [os.path.join(tmpdir, 'clf.so')]
+
+            # Windows library
+            os.rename(os.path.join(tmpdir, 'clf.so'),
+                      os.path.join(tmpdir, 'clf.dll'))
+            with patch.dict('sys.modules', {'treelite_runtime': stub}):
+                clf = sls._load_model(path_model)
+            assert type(clf).__name__ == '_TreeliteClassifier'
+            assert libpaths[-1] == os.path.join(tmpdir, 'clf.dll')